@@ -50,17 +50,49 @@ if sys.version_info < MIN_PYTHON:
     sys.exit("Python %s.%s or later is required.\n" % MIN_PYTHON)
 
 import argparse
+import hashlib
 import json
+import os
+import stat
 import string
+import tempfile
+import time
 import urllib3
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from enum import Enum
+from operator import itemgetter
+from pathlib import Path
+
+# httpx (with the h2 package for HTTP/2 support) is optional - we fall back to requests.
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
+
+# orjson parses large responses (big alert lists, lots of pools) considerably faster than
+# the standard json module. It's optional - we fall back to json if it isn't installed.
+try:
+    import orjson
+    parse_json = orjson.loads
+except ImportError:
+    parse_json = json.loads
+
+# Whether a file was created by the user running this script. Platforms without os.getuid
+# (Windows) have no such ownership to check, so there everything counts as ours.
+def owned_by_current_user(file_stat):
+    if (not hasattr(os, 'getuid')):
+        return True
+    return file_stat.st_uid == os.getuid()
 
-class RequestTypeEnum(Enum):
-    GET_REQUEST = 1
-    POST_REQUEST = 2
+default_zpool_warning_percent = 80
+default_zool_critical_percent = 90
+default_update_cache_ttl_seconds = 3600
+default_timeout_seconds = 15
+connect_timeout_seconds = 5
 
 @dataclass
 class ZpoolCapacity:
@@ -69,9 +101,14 @@ class ZpoolCapacity:
     TotalUsedBytesForAllDatasets: int
   
 
+# Raised when a request to the TrueNAS server fails. The message is the Nagios UNKNOWN status line.
+class RequestFailedError(Exception):
+    pass
+
+
 class Startup(object):
 
-    def __init__(self, hostname, user, secret, use_ssl, verify_cert, ignore_dismissed_alerts, debug_logging, zpool_name, zpool_warn, zpool_critical, show_zpool_perfdata):
+    def __init__(self, hostname, user, secret, use_ssl, verify_cert, ignore_dismissed_alerts, debug_logging, zpool_name, zpool_warn, zpool_critical, show_zpool_perfdata, update_cache_ttl=default_update_cache_ttl_seconds, timeout=default_timeout_seconds):
         self._hostname = hostname
         self._user = user
         self._secret = secret
@@ -83,10 +120,65 @@ class Startup(object):
         self._wfree = zpool_warn
         self._cfree = zpool_critical
         self._show_zpool_perfdata = show_zpool_perfdata
+        self._update_cache_ttl = update_cache_ttl
+        self._timeout = timeout
  
         http_request_header = 'https' if use_ssl else 'http'
  
         self._base_url = ('%s://%s/api/v2.0' % (http_request_header, hostname) )
+
+        # Credentials don't change for the lifetime of the check, so work them out once.
+        # If username provided, try to authenticate with username/password combo
+        if (user):
+            self._auth = (user, secret)
+            self._headers = {}
+        # Otherwise, use API key
+        else:
+            self._auth = None
+            self._headers = {'Authorization': 'Bearer ' + secret}
+
+        # One session for the lifetime of the check, so several API calls can share a
+        # pooled keep-alive connection instead of paying for a new TCP/TLS handshake each time.
+        # If httpx is available we use it with HTTP/2, so concurrent requests (check_all) are
+        # multiplexed over a single connection; otherwise we use requests.
+        self._session = None
+        if (httpx is not None):
+            try:
+                # Unlike requests, httpx doesn't follow redirects unless told to
+                self._session = httpx.Client(http2=True,
+                                             follow_redirects=True,
+                                             verify=verify_cert,
+                                             auth=self._auth,
+                                             headers=self._headers,
+                                             limits=httpx.Limits(max_connections=10, max_keepalive_connections=10))
+                # httpx wants raw request bodies passed as content, requests as data
+                self._payload_argument = 'content'
+                self._request_timeout = httpx.Timeout(timeout, connect=connect_timeout_seconds)
+                self._timeout_errors = httpx.TimeoutException
+                self._connection_errors = httpx.NetworkError
+                self._request_errors = httpx.HTTPError
+            # httpx older than 0.20 doesn't know follow_redirects (or some of the other bits we
+            # use), so we use requests instead
+            except (TypeError, AttributeError):
+                self._session = None
+
+        self._use_httpx = (self._session is not None)
+        if (not self._use_httpx):
+            # We get annoying warning text output from the urllib3 library if we fail to do this.
+            # Done once here rather than on every request.
+            if (not verify_cert):
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+            self._session = requests.Session()
+            self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10))
+            self._session.verify = verify_cert
+            self._session.auth = self._auth
+            self._session.headers.update(self._headers)
+            self._payload_argument = 'data'
+            self._request_timeout = (connect_timeout_seconds, timeout)
+            self._timeout_errors = requests.exceptions.Timeout
+            self._connection_errors = requests.exceptions.ConnectionError
+            self._request_errors = requests.exceptions.RequestException
         
         self.setup_logging()
         self.log_startup_information()
@@ -97,102 +189,99 @@ class Startup(object):
         logging.debug('use_ssl: %s', self._use_ssl)
         logging.debug('verify_cert: %s', self._verify_cert)
         logging.debug('base_url: %s', self._base_url)
+        logging.debug('http client: %s', type(self._session).__module__)
         logging.debug('zpool_name: %s', self._zpool_name)
         logging.debug('wfree: %d', self._wfree)
         logging.debug('cfree: %d', self._cfree)
+        logging.debug('update_cache_ttl: %d', self._update_cache_ttl)
+        logging.debug('timeout: %d', self._timeout)
         logging.debug('')
  
 
-    # Do a GET or POST request
-    def do_request(self, resource, requestType, optionalPayload):
+    # Do a GET or POST request. If retryWithoutPayloadIfRejected is set and the server refuses
+    # the payload as invalid, the request is made again without it.
+    def do_request(self, method, resource, optionalPayload, retryWithoutPayloadIfRejected=False):
+        payloadRejected = False
         try:
             request_url = '%s/%s/' % (self._base_url, resource)
             logging.debug('request_url: %s', request_url)
-            logging.debug('requestType: ' + repr(requestType))
-            #logging.debug('optionalPayloadAsJson:' + optionalPayloadAsJson)
-
-            # We assume that all incoming payloads are JSON. 
-            optionalPayloadAsJson = json.dumps(optionalPayload)
-            logging.debug('optionalPayloadAsJson:' + optionalPayloadAsJson)
-            
-            # We get annoying warning text output from the urllib3 library if we fail to do this
-            if (not self._verify_cert):
-                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            auth=False
-            headers={}
-
-            # If username provided, try to authenticate with username/password combo
-            if (self._user): 
-                auth=(self._user, self._secret)
-            # Otherwise, use API key
-            else: 
-                headers={'Authorization': 'Bearer ' + self._secret}
-            
-            # GET Request
-            if (requestType is RequestTypeEnum.GET_REQUEST):
-                if (optionalPayload):
-                    r = requests.get(request_url, 
-                                    auth=auth,
-                                    headers=headers,
-                                    data=optionalPayloadAsJson,
-                                    verify=self._verify_cert)
-                else:
-                    r = requests.get(request_url, 
-                                    auth=auth,
-                                    headers=headers,
-                                    verify=self._verify_cert)                    
-                logging.debug('GET request response: %s', r.text)
-            # POST Request                
-            elif (requestType is RequestTypeEnum.POST_REQUEST):
-                if (optionalPayload):                
-                    r = requests.post(request_url, 
-                                    auth=auth,
-                                    headers=headers,
-                                    data=optionalPayloadAsJson,
-                                    verify=self._verify_cert)
-                else:
-                    r = requests.post(request_url, 
-                                    auth=auth,
-                                    headers=headers,
-                                    verify=self._verify_cert)
-                logging.debug('POST request response: %s', r.text)
-            else:
-                print ('UNKNOWN - request failed - Unknown RequestType: ' + requestType)
-                sys.exit(3)
-
-            r.raise_for_status()
-        except:
-            print ('UNKNOWN - request failed - Error when contacting TrueNAS server: ' + str(sys.exc_info()) )
-            sys.exit(3)
+            logging.debug('request method: %s', method)
+
+            # Without a timeout a hung TrueNAS server would block the check until Nagios kills it
+            request_arguments = {'timeout': self._request_timeout}
+
+            # requests lets a CA bundle from REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE override the session's
+            # verify setting, which would break -nv. Passing verify with each request takes priority.
+            if (not self._use_httpx):
+                request_arguments['verify'] = self._verify_cert
+            if (optionalPayload):
+                # We assume that all incoming payloads are JSON. 
+                optionalPayloadAsJson = json.dumps(optionalPayload)
+                logging.debug('optionalPayloadAsJson: %s', optionalPayloadAsJson)
+                request_arguments[self._payload_argument] = optionalPayloadAsJson
+
+            r = self._session.request(method, request_url, **request_arguments)
+
+            # r.text decodes the whole response body, so only touch it when we're actually logging it
+            if (self._logger.isEnabledFor(logging.DEBUG)):
+                logging.debug('Request response: %s', r.text)
+
+            payloadRejected = (retryWithoutPayloadIfRejected and optionalPayload and r.status_code in (400, 422))
+            if (not payloadRejected):
+                r.raise_for_status()
+        # Check for timeouts first: a requests connect timeout is also a ConnectionError.
+        # Some httpx error messages span several lines, but Nagios only shows the first one.
+        except self._timeout_errors as e:
+            raise RequestFailedError('UNKNOWN - request failed - Timeout after ' + str(self._timeout) + ' seconds when contacting TrueNAS server (connect timeout ' + str(connect_timeout_seconds) + ' seconds): ' + str(e).replace('\n', ' '))
+        except self._connection_errors as e:
+            raise RequestFailedError('UNKNOWN - request failed - Could not connect to TrueNAS server: ' + str(e).replace('\n', ' '))
+        except self._request_errors as e:
+            raise RequestFailedError('UNKNOWN - request failed - Error when contacting TrueNAS server: ' + str(e).replace('\n', ' '))
+
+        if (payloadRejected):
+            logging.debug('Payload rejected with HTTP status %d, retrying without it', r.status_code)
+            return self.do_request(method, resource, None)
  
-        if r.ok:
-            try:
-                return r.json()
-            except:
-                print ('UNKNOWN - json failed to parse - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-                sys.exit(3)
+        try:
+            return parse_json(r.content)
+        except ValueError as e:
+            raise RequestFailedError('UNKNOWN - json failed to parse - Error when contacting TrueNAS server: ' + str(e))
 
     # GET request
     def get_request(self, resource):
-        return self.do_request(resource, RequestTypeEnum.GET_REQUEST, None)
+        return self.do_request('GET', resource, None)
 
     # GET request with payload
     def get_request_with_payload(self, resource, optionalPayload):
-        return self.do_request(resource, RequestTypeEnum.GET_REQUEST, optionalPayload)
+        return self.do_request('GET', resource, optionalPayload)
+
+    # GET request for a query resource (pool, replication, ...), asking the server to only send
+    # back the given fields instead of the complete objects. TrueNAS versions that don't know the
+    # 'select' query option reject it, in which case we fetch the complete objects after all.
+    def get_request_selecting_fields(self, resource, fields):
+        selectPayload = {
+            'query-options': {
+                'select': fields
+            }
+        }
+        return self.do_request('GET', resource, selectPayload, retryWithoutPayloadIfRejected=True)
 
     # POST request
     def post_request(self, resource):
-        return self.do_request(resource, RequestTypeEnum.POST_REQUEST, None)
+        return self.do_request('POST', resource, None)
 
     # POST request with payload
     def post_request_with_payload(self, resource, optionalPayload):
-        return self.do_request(resource, RequestTypeEnum.POST_REQUEST, optionalPayload)
+        return self.do_request('POST', resource, optionalPayload)
 
     def check_repl(self):
-        repls = self.get_request('replication')
+        repls = self.get_request_selecting_fields('replication', ['name', 'state'])
+        self.exit_with_status(*self.evaluate_repl(repls))
+
+    def evaluate_repl(self, repls):
         errors=0
-        msg=''
-        replications_examined = ''
+        failed_replications = []
+        replications_examined = []
 
         try:
             for repl in repls:
@@ -204,27 +293,93 @@ class Startup(object):
                 repl_state_code = repl_state_obj['state']
                 logging.debug('Replication state code: %s', repl_state_code)
 
-                replications_examined = replications_examined + ' ' + repl_name + ': ' + repl_state_code
+                replications_examined.append(repl_name + ': ' + repl_state_code)
                 
                 repl_was_not_success = (repl_state_code != 'FINISHED')
                 repl_not_running = (repl_state_code != 'RUNNING')
                 if (repl_was_not_success and repl_not_running):
                     errors = errors + 1
-                    msg = msg + repl_name + ': ' + repl_state_code
-        except:
-            print ('UNKNOWN - check_repl() - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-            sys.exit(3)
+                    failed_replications.append(repl_name + ': ' + repl_state_code)
+        except (KeyError, TypeError) as e:
+            return (3, 'UNKNOWN - check_repl() - Error when contacting TrueNAS server: ' + repr(e))
  
         if errors > 0:
-            print ('WARNING - There are ' + str(errors) + ' replication errors [' + msg.strip() + ']. Go to Storage > Replication Tasks > View Replication Tasks in TrueNAS for more details.')
-            sys.exit(1)
+            return (1, 'WARNING - There are ' + str(errors) + ' replication errors [' + ', '.join(failed_replications) + ']. Go to Storage > Replication Tasks > View Replication Tasks in TrueNAS for more details.')
         else:
-            print ('OK - No replication errors. Replications examined: ' + replications_examined)
-            sys.exit(0)
+            return (0, 'OK - No replication errors. Replications examined: ' + ' '.join(replications_examined))
 
 
     def check_update(self):
+        updateCheckResult = self.get_update_check_result()
+        self.exit_with_status(*self.evaluate_update(updateCheckResult))
+
+    # Asking TrueNAS whether an update is available makes it go and check the update servers,
+    # which can take several seconds, while the answer rarely changes. So we keep the last
+    # answer in a file in the user's cache directory and reuse it until it is older than the TTL.
+    def get_update_check_result(self):
+        if (self._update_cache_ttl <= 0):
+            return self.post_request('update/check_available')
+
+        cache_path = self.get_update_check_cache_path()
+
+        updateCheckResult = self.read_update_check_cache(cache_path)
+        if (updateCheckResult is not None):
+            logging.debug('Using cached update check result from %s', cache_path)
+            return updateCheckResult
+
         updateCheckResult = self.post_request('update/check_available')
+        self.write_update_check_cache(cache_path, updateCheckResult)
+        return updateCheckResult
+
+    # The cache lives in a per-user directory (not the shared temp directory, where anyone could
+    # plant a fake result or a symlink), with one file per server URL (including port) and user
+    def get_update_check_cache_path(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_key = '%s|%s' % (self._base_url, self._user or '')
+        return Path(cache_home) / 'check_truenas_extended_play' / ('update_%s.json' % hashlib.sha1(cache_key.encode()).hexdigest())
+
+    # Returns the cached result, or None if there is no usable cache file. Symlinks, files owned
+    # by other users and files older than the TTL are ignored.
+    def read_update_check_cache(self, cache_path):
+        try:
+            fd = os.open(cache_path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+            with os.fdopen(fd, 'rb') as cache_file:
+                cache_file_stat = os.fstat(cache_file.fileno())
+                if (not stat.S_ISREG(cache_file_stat.st_mode) or not owned_by_current_user(cache_file_stat)):
+                    logging.debug('Ignoring update check cache file %s, not a regular file of ours', cache_path)
+                    return None
+                if (time.time() - cache_file_stat.st_mtime >= self._update_cache_ttl):
+                    return None
+                return parse_json(cache_file.read())
+        except (OSError, ValueError):
+            # No cache file yet, or one we can't read - just ask the server
+            return None
+
+    # Writes the cache through a temp file in the same directory and os.replace, so a reader never
+    # sees a half-written file and an existing symlink at cache_path is replaced, not followed
+    def write_update_check_cache(self, cache_path, updateCheckResult):
+        temp_path = None
+        try:
+            cache_dir = cache_path.parent
+            cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            cache_dir_stat = os.lstat(cache_dir)
+            if (not stat.S_ISDIR(cache_dir_stat.st_mode) or not owned_by_current_user(cache_dir_stat)):
+                logging.debug('Not writing update check cache, %s is not a directory of ours', cache_dir)
+                return
+
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.update_', suffix='.tmp')
+            with os.fdopen(fd, 'w') as temp_file:
+                temp_file.write(json.dumps(updateCheckResult))
+            os.replace(temp_path, cache_path)
+        except OSError:
+            logging.debug('Could not write update check cache file %s', cache_path)
+            if (temp_path is not None and os.path.exists(temp_path)):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def evaluate_update(self, updateCheckResult):
         warnings=0
         errors=0
         msg=''
@@ -246,116 +401,148 @@ class Startup(object):
             # Despite that it sounds error-y, 'UNAVAILABLE' is actually the normal everything-is-ok state.
             needsUpdateOrOtherPossibleIssue = (updateCheckResultString != 'UNAVAILABLE')
 
-        except:
-            print ('UNKNOWN - check_update() - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-            sys.exit(3)
+        except (KeyError, TypeError) as e:
+            return (3, 'UNKNOWN - check_update() - Error when contacting TrueNAS server: ' + repr(e))
  
         if needsUpdateOrOtherPossibleIssue:
             if (updateCheckResultString in updateCheckResultDict):
-                print ('WARNING - Update Status: ' + updateCheckResultString + ' (' + updateCheckResultDict[updateCheckResultString] + '). Update may be required. Go to TrueNAS Dashboard -> System -> Update to check for newer version.')
+                return (1, 'WARNING - Update Status: ' + updateCheckResultString + ' (' + updateCheckResultDict[updateCheckResultString] + '). Update may be required. Go to TrueNAS Dashboard -> System -> Update to check for newer version.')
             # Unfamiliar status we've never seen before    
             else:
-                print ('WARNING - Unknown Update Status: ' + updateCheckResultString + '. Update may be required. Go to TrueNAS Dashboard -> System -> Update to check for newer version.')
-            sys.exit(1)
+                return (1, 'WARNING - Unknown Update Status: ' + updateCheckResultString + '. Update may be required. Go to TrueNAS Dashboard -> System -> Update to check for newer version.')
         else:
-            print ('OK - Update Status: ' + updateCheckResultString + ' (' + updateCheckResultDict[updateCheckResultString] + ')')
-            sys.exit(0)
+            return (0, 'OK - Update Status: ' + updateCheckResultString + ' (' + updateCheckResultDict[updateCheckResultString] + ')')
 
 
     def check_alerts(self):
         alerts = self.get_request('alert/list')
-        
+        self.exit_with_status(*self.evaluate_alerts(alerts))
+
+    def evaluate_alerts(self, alerts):
         logging.debug('alerts: %s', alerts)
         
-        warn=0
-        crit=0
-        critical_messages = ''
-        warning_messages = ''
+        get_alert_fields = itemgetter('level', 'formatted')
         try:
-            for alert in alerts:
-                # Skip over dismissed alerts if that's what user requested 
-                if (self._ignore_dismissed_alerts and alert['dismissed'] == True):
-                    continue
-                if alert['level'] == 'CRITICAL':
-                    crit = crit + 1
-                    critical_messages = critical_messages + '- (C) ' + alert['formatted'].replace('\n', '. ') + ' '
-                elif alert['level'] == 'WARNING':
-                    warn = warn + 1
-                    warning_messages = warning_messages + '- (W) ' + alert['formatted'].replace('\n', '. ') + ' '
-        except:
-            print ('UNKNOWN - check_alerts() - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-            sys.exit(3)
-        
+            # Skip over dismissed alerts if that's what user requested 
+            if (self._ignore_dismissed_alerts):
+                alerts = [alert for alert in alerts if alert.get('dismissed') != True]
+
+            alert_rows = [get_alert_fields(alert) for alert in alerts]
+
+            critical_messages = ['- (C) ' + formatted for (level, formatted) in alert_rows if level == 'CRITICAL']
+            warning_messages = ['- (W) ' + formatted for (level, formatted) in alert_rows if level == 'WARNING']
+        # AttributeError: alert.get() on something that isn't a dict, e.g. an error body
+        except (KeyError, TypeError, AttributeError) as e:
+            return (3, 'UNKNOWN - check_alerts() - Error when contacting TrueNAS server: ' + repr(e))
+
+        crit = len(critical_messages)
+        warn = len(warning_messages)
+
+        # Alert texts can span several lines, but Nagios only wants one. The line breaks are
+        # turned into sentence breaks once, on the final message, rather than alert by alert.
         if crit > 0:
             # Show critical errors before any warnings
-            print ('CRITICAL ' + critical_messages + warning_messages)
-            sys.exit(2)
+            return (2, ('CRITICAL ' + ' '.join(critical_messages + warning_messages)).replace('\n', '. '))
         elif warn > 0:
-            print ('WARNING ' + warning_messages)
-            sys.exit(1)
+            return (1, ('WARNING ' + ' '.join(warning_messages)).replace('\n', '. '))
         else:
-            print ('OK - No problem alerts')
-            sys.exit(0)
+            return (0, 'OK - No problem alerts')
  
     def check_zpool(self):
-        pool_results = self.get_request('pool')
+        pool_results = self.get_request_selecting_fields('pool', ['name', 'status'])
+        self.exit_with_status(*self.evaluate_zpool(pool_results))
 
+    def evaluate_zpool(self, pool_results):
         #logging.debug('pool_results: %s', pool_results)
         
         warn=0
         crit=0
-        critical_messages = ''
-        warning_messages = ''
-        zpools_examined = ''
-        actual_zpool_count = 0
-        all_pool_names = ''
+        critical_messages = []
+        warning_messages = []
+        zpools_examined = []
         
         looking_for_all_pools = self._zpool_name.lower() == 'all'
         
         try:
-            for pool in pool_results:
+            actual_zpool_count = len(pool_results)
 
-                actual_zpool_count += 1
+            # Either match all pools, or only the requested pool. A single requested pool is
+            # looked up by name rather than by walking every pool on the system.
+            if (looking_for_all_pools):
+                relevant_pools = pool_results
+            else:
+                pools_by_name = {pool['name']: pool for pool in pool_results}
+                requested_pool = pools_by_name.get(self._zpool_name)
+                relevant_pools = [requested_pool] if requested_pool is not None else []
+
+            for pool in relevant_pools:
                 pool_name = pool['name']
                 pool_status = pool['status']
+
+                logging.debug('Relevant Zpool found: %s with status %s', pool_name, pool_status)
+                zpools_examined.append(pool_name)
+                logging.debug('zpools_examined: %s', zpools_examined)
+                if (pool_status != 'ONLINE'):
+                    crit = crit + 1
+                    critical_messages.append('- (C) ZPool ' + pool_name + ' is ' + pool_status)
+
+            # There were no Zpools on the system, and we were looking for all of them
+            if (not zpools_examined and actual_zpool_count == 0 and looking_for_all_pools):
+                zpools_examined = ['(None - No Zpools found)']
                 
-                all_pool_names += pool_name + ' '
-                
-                logging.debug('Checking zpool for relevancy: %s with status %s', pool_name, pool_status)
-                
-                # Either match all pools, or only the requested pool
-                if (looking_for_all_pools or self._zpool_name == pool_name):
-                    logging.debug('Relevant Zpool found: %s with status %s', pool_name, pool_status)
-                    zpools_examined = zpools_examined + ' ' + pool_name
-                    logging.debug('zpools_examined: %s', zpools_examined)
-                    if (pool_status != 'ONLINE'):
-                        crit = crit + 1
-                        critical_messages = critical_messages + '- (C) ZPool ' + pool_name + 'is ' + pool_status
-        except:
-            print ('UNKNOWN - check_zpool() - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-            sys.exit(3)
-        
-        # There were no Zpools on the system, and we were looking for all of them
-        if (zpools_examined == '' and actual_zpool_count == 0 and looking_for_all_pools):
-            zpools_examined = '(None - No Zpools found)'
-            
-        # There were no Zpools matching a specific name on the system
-        if (zpools_examined == '' and actual_zpool_count > 0 and not looking_for_all_pools and crit == 0):
-            crit = crit + 1
-            critical_messages = '- No Zpools found matching {} out of {} pools ({})'.format(self._zpool_name, actual_zpool_count, all_pool_names)
+            # There were no Zpools matching a specific name on the system
+            if (not zpools_examined and actual_zpool_count > 0 and not looking_for_all_pools):
+                crit = crit + 1
+                all_pool_names = ' '.join(pool['name'] for pool in pool_results)
+                critical_messages = ['- No Zpools found matching {} out of {} pools ({})'.format(self._zpool_name, actual_zpool_count, all_pool_names)]
+        except (KeyError, TypeError) as e:
+            return (3, 'UNKNOWN - check_zpool() - Error when contacting TrueNAS server: ' + repr(e))
 
         if crit > 0:
             # Show critical errors before any warnings
-            print ('CRITICAL ' + critical_messages + warning_messages)
-            sys.exit(2)
+            return (2, 'CRITICAL ' + ' '.join(critical_messages + warning_messages))
         elif warn > 0:
-            print ('WARNING ' + warning_messages)
-            sys.exit(1)
+            return (1, 'WARNING ' + ' '.join(warning_messages))
         else:
-            print ('OK - No problem Zpools. Zpools examined: ' + zpools_examined)
-            sys.exit(0)
+            return (0, 'OK - No problem Zpools. Zpools examined: ' + ' '.join(zpools_examined))
+
+    # Run the alerts, zpool, repl and update checks in one go. Their API calls don't depend
+    # on each other and are almost entirely time spent waiting on the server, so we fire them
+    # off concurrently over the shared session and then evaluate the results one by one.
+    # A failed request only makes its own check UNKNOWN; the other checks are still reported.
+    def check_all(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            alerts_future = executor.submit(self.get_request, 'alert/list')
+            pool_future = executor.submit(self.get_request_selecting_fields, 'pool', ['name', 'status'])
+            repl_future = executor.submit(self.get_request_selecting_fields, 'replication', ['name', 'state'])
+            update_future = executor.submit(self.get_update_check_result)
+
+            results = [
+                ('alerts', self.evaluate_fetched(alerts_future, self.evaluate_alerts)),
+                ('zpool', self.evaluate_fetched(pool_future, self.evaluate_zpool)),
+                ('repl', self.evaluate_fetched(repl_future, self.evaluate_repl)),
+                ('update', self.evaluate_fetched(update_future, self.evaluate_update))
+            ]
+
+        # Report the worst status found. Nagios ranks UNKNOWN between WARNING and CRITICAL.
+        severity_order = [0, 1, 3, 2]
+        worst_exit_code = max((exit_code for (check_name, (exit_code, message)) in results), key=severity_order.index)
+
+        combined_message = ' / '.join(check_name + ': ' + message.strip() for (check_name, (exit_code, message)) in results)
+        self.exit_with_status(worst_exit_code, nagios_status_names[worst_exit_code] + ' - ' + combined_message)
+
+    # Evaluate the result of a request made by check_all, or report it as UNKNOWN if it failed
+    def evaluate_fetched(self, future, evaluate):
+        try:
+            return evaluate(future.result())
+        except RequestFailedError as e:
+            return (3, str(e))
+
+    # Print the Nagios status line and exit
+    def exit_with_status(self, exit_code, message):
+        print (message)
+        sys.exit(exit_code)
 
-    
 
     def check_zpool_capacity(self):
         # As far as I can tell, we unfortunately have to look at the datasets to get a usable
@@ -440,7 +627,7 @@ class Startup(object):
                     # Otherwise we've seen it before, update our count of used bytes
                     else:
                         zpoolNameToCapacityDict[dataset_pool_name].TotalUsedBytesForAllDatasets += dataset_used_bytes
-                    logging.debug('currentZpoolCapacity: ' + str(zpoolNameToCapacityDict[dataset_pool_name]))
+                    logging.debug('currentZpoolCapacity: %s', zpoolNameToCapacityDict[dataset_pool_name])
 
 
             # So now we have summary data on all the Zpools we care about. Go through each of them 
@@ -450,8 +637,8 @@ class Startup(object):
                 usedPercentage = (currentZpoolCapacity.TotalUsedBytesForAllDatasets / zpoolTotalBytes ) * 100;
                 usagePercentDisplayString = f'{usedPercentage:3.1f}'
                 
-                logging.debug('Warning capacity: ' + str(warnZpoolCapacityPercent) + '%' + ' Critical capacity: ' + str(critZpoolCapacityPercent) + '%')                 
-                logging.debug('ZPool ' + str(currentZpoolCapacity.ZpoolName) + ' usedPercentage: ' + usagePercentDisplayString + '%')  
+                logging.debug('Warning capacity: %s%% Critical capacity: %s%%', warnZpoolCapacityPercent, critZpoolCapacityPercent)                 
+                logging.debug('ZPool %s usedPercentage: %s%%', currentZpoolCapacity.ZpoolName, usagePercentDisplayString)  
                 
                 # Add warning/critical errors for the current ZPool summary being checked, if needed
                 if (usedPercentage >= critZpoolCapacityPercent):
@@ -482,16 +669,15 @@ class Startup(object):
                     totalMegabytes = zpoolTotalBytes / BYTES_IN_MEGABYTE
                     totalMegabytesString = f'{totalMegabytes:3.2f}' 
 
-                    logging.debug('usedMegabytesString: ' + usedMegabytesString)  
-                    logging.debug('warningMegabytesString: ' + warningMegabytesString)  
-                    logging.debug('criticalMegabytesString: ' + criticalMegabytesString)                      
-                    logging.debug('totalMegabytesString: ' + totalMegabytesString)  
+                    logging.debug('usedMegabytesString: %s', usedMegabytesString)  
+                    logging.debug('warningMegabytesString: %s', warningMegabytesString)  
+                    logging.debug('criticalMegabytesString: %s', criticalMegabytesString)                      
+                    logging.debug('totalMegabytesString: %s', totalMegabytesString)  
 
                     perfdata += " " + currentZpoolCapacity.ZpoolName + "=" + usedMegabytesString + "MB;" + warningMegabytesString + ";" + criticalMegabytesString + ";0;" + totalMegabytesString                                
 
-        except:
-            print ('UNKNOWN - check_zpool() - Error when contacting TrueNAS server: ' + str(sys.exc_info()))
-            sys.exit(3)
+        except (KeyError, TypeError, ZeroDivisionError) as e:
+            self.exit_with_status(3, 'UNKNOWN - check_zpool() - Error when contacting TrueNAS server: ' + repr(e))
         
         # There were no datasets on the system, and we were looking for datasets from any pool
         if (root_level_datasets_examined == '' and root_level_dataset_count == 0 and looking_for_all_pools):
@@ -507,35 +693,29 @@ class Startup(object):
         error_or_warning_dividing_dash = ''
         if (len(zpools_examined_with_no_issues) > 0):
             error_or_warning_dividing_dash = ' - '
-            logging.debug('Yes there is a dividing dash:' + error_or_warning_dividing_dash)
+            logging.debug('Yes there is a dividing dash:%s', error_or_warning_dividing_dash)
 
         if crit > 0:
             # Show critical errors before any warnings
-            print ('CRITICAL' + critical_messages + warning_messages + error_or_warning_dividing_dash + zpools_examined_with_no_issues + perfdata)
-            sys.exit(2)
+            self.exit_with_status(2, 'CRITICAL' + critical_messages + warning_messages + error_or_warning_dividing_dash + zpools_examined_with_no_issues + perfdata)
         elif warn > 0:
-            print ('WARNING' + warning_messages + error_or_warning_dividing_dash + zpools_examined_with_no_issues + perfdata)
-            sys.exit(1)
+            self.exit_with_status(1, 'WARNING' + warning_messages + error_or_warning_dividing_dash + zpools_examined_with_no_issues + perfdata)
         else:
-            print ('OK - No Zpool capacity issues. ZPools examined: ' + zpools_examined_with_no_issues + ' - Root level datasets examined:' + root_level_datasets_examined + perfdata)
-            sys.exit(0)
+            self.exit_with_status(0, 'OK - No Zpool capacity issues. ZPools examined: ' + zpools_examined_with_no_issues + ' - Root level datasets examined:' + root_level_datasets_examined + perfdata)
 
 
 
     def handle_requested_alert_type(self, alert_type):
-        if alert_type == 'alerts':
-            self.check_alerts()
-        elif alert_type == 'repl':
-            self.check_repl()
-        elif alert_type == 'update':
-            self.check_update()
-        elif alert_type == 'zpool':
-            self.check_zpool()
-        elif alert_type == 'zpool_capacity':
-            self.check_zpool_capacity()
-        else:
-            print ("Unknown type: " + alert_type)
-            sys.exit(3)
+        check_method = Startup._DISPATCH.get(alert_type)
+        # argparse already rejects unknown types on the command line; this is for code that
+        # creates a Startup and calls us directly
+        if (check_method is None):
+            self.exit_with_status(3, 'Unknown type: ' + alert_type)
+
+        try:
+            check_method(self)
+        except RequestFailedError as e:
+            self.exit_with_status(3, str(e))
 
     def setup_logging(self):
         logger = logging.getLogger()
@@ -547,18 +727,48 @@ class Startup(object):
             #print('Should be setting no logging level at all')
             logger.setLevel(logging.CRITICAL)
 
+        self._logger = logger
+
+    # Check type (as given with -t/--type) to the method that runs it
+    _DISPATCH = {
+        'all': check_all,
+        'alerts': check_alerts,
+        'repl': check_repl,
+        'update': check_update,
+        'zpool': check_zpool,
+        'zpool_capacity': check_zpool_capacity
+    }
+
 check_truenas_script_version = '1.41'
 
-default_zpool_warning_percent = 80
-default_zool_critical_percent = 90
+nagios_status_names = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+
+# argparse exits with status 2 on bad arguments, which Nagios would show as CRITICAL.
+# A usage error is UNKNOWN (3) by Nagios plugin convention.
+class NagiosArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        print ('UNKNOWN - ' + message)
+        sys.exit(3)
+
+# argparse type for options that must be a whole number above zero. argparse reports the
+# ArgumentTypeError through parser.error, so this ends up as an UNKNOWN usage error.
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: ' + repr(value))
+    if (number <= 0):
+        raise argparse.ArgumentTypeError('must be greater than 0, got ' + value)
+    return number
 
 def main():
     # Build parser for arguments
-    parser = argparse.ArgumentParser(description='Checks a TrueNAS/FreeNAS server using the 2.0 API. Version ' + check_truenas_script_version)
+    parser = NagiosArgumentParser(description='Checks a TrueNAS/FreeNAS server using the 2.0 API. Version ' + check_truenas_script_version)
     parser.add_argument('-H', '--hostname', required=True, type=str, help='Hostname or IP address')
     parser.add_argument('-u', '--user', required=False, type=str, help='Username, only root works, if not specified: use API Key')
     parser.add_argument('-p', '--passwd', required=True, type=str, help='Password or API Key')
-    parser.add_argument('-t', '--type', required=True, type=str, help='Type of check, either alerts, zpool, zpool_capacity, repl, or update')
+    parser.add_argument('-t', '--type', required=True, type=str, choices=Startup._DISPATCH.keys(), help='Type of check, either alerts, zpool, zpool_capacity, repl, update, or all (runs alerts, zpool, repl and update together)')
     parser.add_argument('-pn', '--zpoolname', required=False, type=str, default='all', help='For check type zpool, the name of zpool to check. Optional; defaults to all zpools.')
     parser.add_argument('-ns', '--no-ssl', required=False, action='store_true', help='Disable SSL (use HTTP); default is to use SSL (use HTTPS)')
     parser.add_argument('-nv', '--no-verify-cert', required=False, action='store_true', help='Do not verify the server SSL cert; default is to verify the SSL cert')
@@ -567,6 +777,8 @@ def main():
     parser.add_argument('-zw', '--zpool-warn', required=False, type=int, default=default_zpool_warning_percent, help='ZPool warning storage capacity free threshold. Give a percent value in the range 1-100, defaults to ' + str(default_zpool_warning_percent) + '%%. Used with zpool_capacity check.')    
     parser.add_argument('-zc', '--zpool-critical', required=False, type=int, default=default_zool_critical_percent, help='ZPool critical storage capacity free threshold. Give a percent value in the range 1-100, defaults to ' + str(default_zool_critical_percent) +'%%. Used with zpool_capacity check.')
     parser.add_argument('-zp', '--zpool-perfdata', required=False, action='store_true', help='Add Zpool capacity perf data to output. Used with zpool_capacity check.')    
+    parser.add_argument('-ut', '--update-cache-ttl', required=False, type=int, default=default_update_cache_ttl_seconds, help='Seconds to reuse the result of the last update check before asking TrueNAS again, defaults to ' + str(default_update_cache_ttl_seconds) + '. Use 0 to always ask. Used with update check.')
+    parser.add_argument('-to', '--timeout', required=False, type=positive_int, default=default_timeout_seconds, help='Seconds to wait for TrueNAS to answer a request, defaults to ' + str(default_timeout_seconds) + '. Connecting to the server always times out after ' + str(connect_timeout_seconds) + ' seconds.')
     
     # if no arguments, print out help
     if len(sys.argv)==1:
@@ -579,7 +791,7 @@ def main():
     use_ssl = not args.no_ssl
     verify_ssl_cert = not args.no_verify_cert
  
-    startup = Startup(args.hostname, args.user, args.passwd, use_ssl, verify_ssl_cert, args.ignore_dismissed_alerts, args.debug, args.zpoolname, args.zpool_warn, args.zpool_critical, args.zpool_perfdata)
+    startup = Startup(args.hostname, args.user, args.passwd, use_ssl, verify_ssl_cert, args.ignore_dismissed_alerts, args.debug, args.zpoolname, args.zpool_warn, args.zpool_critical, args.zpool_perfdata, args.update_cache_ttl, args.timeout)
  
     startup.handle_requested_alert_type(args.type)
  